@@ -1,7 +1,12 @@
+import os
+import threading
+import time
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 from streamlit_gsheets import GSheetsConnection
 
 # --- 页面配置 ---
@@ -9,25 +14,127 @@ st.set_page_config(page_title="云端投资追踪器 (GSheets)", layout="wide",
 
 # --- 数据库操作 (Google Sheets) ---
 
+# 建立连接（整个脚本共用一个连接对象）
+CONN = st.connection("gsheets", type=GSheetsConnection)
+
 # 定义表头结构
 COLUMNS = [
     "id", "symbol", "buy_price", "sell_price", "quantity", 
     "open_date", "close_date", "pnl", "pnl_percent", "status", "notes"
 ]
 
-def get_data():
-    """从 Google Sheets 读取数据"""
-    # 建立连接
-    conn = st.connection("gsheets", type=GSheetsConnection)
-    # ttl=0 表示不缓存，每次都强制从云端拉取最新数据
-    df = conn.read(worksheet="Sheet1", ttl=0)
+# 数值列及其目标类型（缺失值统一补 0）
+NUMERIC_DTYPES = {
+    "id": "int64", "quantity": "int64",
+    "buy_price": "float64", "sell_price": "float64", "pnl": "float64"
+}
+DATE_COLUMNS = ["open_date", "close_date"]
+# 页面上日期只显示到天（在浏览器端格式化，不需要先复制数据）
+DATE_COLUMN_CONFIG = {col: st.column_config.DateColumn(format="YYYY-MM-DD") for col in DATE_COLUMNS}
+
+# 本地磁盘缓存（Feather），进程重启或新会话时先读它，不必等 Google Sheets
+DISK_CACHE_PATH = os.path.join(".cache", "trades.feather")
+# 磁盘缓存有效期（秒），可通过环境变量调整
+DISK_CACHE_TTL = int(os.environ.get("STOCK_TRACER_DISK_CACHE_TTL", 600))
+
+def _read_disk_cache():
+    """磁盘缓存存在且未过期时返回 DataFrame，否则返回 None"""
+    try:
+        if time.time() - os.path.getmtime(DISK_CACHE_PATH) > DISK_CACHE_TTL:
+            return None
+        return pd.read_feather(DISK_CACHE_PATH)
+    except Exception:
+        # 文件不存在或已损坏，直接回源
+        return None
+
+@st.cache_resource
+def _disk_cache_state():
+    """进程内共享的磁盘缓存状态：写入代数 + 锁
+    
+    脚本每次重跑都会重新执行整个模块，普通全局变量留不住，所以放在 cache_resource 里。
+    """
+    return {"generation": 0, "lock": threading.Lock()}
+
+def _disk_cache_generation():
+    return _disk_cache_state()["generation"]
+
+def _write_disk_cache(df, generation):
+    """原子写入磁盘缓存：先写临时文件再替换
+    
+    generation 是开始读取表格前的代数；期间发生过写入（代数已变）说明这份数据
+    已经过期，直接丢弃并返回 False。
+    """
+    state = _disk_cache_state()
+    with state["lock"]:
+        if state["generation"] != generation:
+            return False
+        if df.empty:
+            # 表格已被清空：删掉旧文件，否则它还在有效期内会被当作最新数据反复读出
+            if os.path.exists(DISK_CACHE_PATH):
+                os.remove(DISK_CACHE_PATH)
+            return True
+        tmp_path = f"{DISK_CACHE_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(DISK_CACHE_PATH), exist_ok=True)
+            df.to_feather(tmp_path)
+            os.replace(tmp_path, DISK_CACHE_PATH)
+        except Exception:
+            # 缓存写入失败（如某列混有数字和文字，Arrow 无法转换）不影响主流程
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return True
+
+def _clear_disk_cache():
+    """写入表格后调用：代数加一，并删除磁盘缓存"""
+    state = _disk_cache_state()
+    with state["lock"]:
+        state["generation"] += 1
+        if os.path.exists(DISK_CACHE_PATH):
+            os.remove(DISK_CACHE_PATH)
+
+def _refresh_disk_cache(disk_df, generation):
+    """后台线程：从 Google Sheets 拉取最新数据，有变化时刷新缓存"""
+    try:
+        df = _fetch_sheet()
+    except Exception:
+        # 配额限制、网络错误等：本次不刷新，继续使用磁盘缓存，下次未命中时再试
+        return
+    if not _write_disk_cache(df, generation):
+        # 读取期间有过写入，写入方已经清掉了所有缓存，这份旧结果直接丢弃
+        return
+    if not df.equals(disk_df):
+        _clear_memory_caches()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_data_cached():
+    """读取数据（带缓存，每次写入后失效）
+    
+    优先使用未过期的磁盘缓存，并在后台线程从 Google Sheets 刷新；
+    否则直接从 Google Sheets 读取并写入磁盘缓存。
+    注意它并不是纯函数：不会写 Google Sheets，但会写本地磁盘缓存，
+    并可能启动后台刷新线程。
+    """
+    generation = _disk_cache_generation()
+    disk_df = _read_disk_cache()
+    if disk_df is not None:
+        thread = threading.Thread(target=_refresh_disk_cache, args=(disk_df, generation), daemon=True)
+        add_script_run_ctx(thread)
+        thread.start()
+        return disk_df
+    
+    df = _fetch_sheet()
+    _write_disk_cache(df, generation)
+    return df
+
+def _fetch_sheet():
+    """从 Google Sheets 读取数据并整理列和类型"""
+    # ttl=0 表示连接层不缓存，缓存统一交给 get_data_cached 管理
+    df = CONN.read(worksheet="Sheet1", ttl=0)
     
-    # 如果是空表，初始化列名
+    # 如果是空表，只返回带列名的空 DataFrame，不在读取时写表
+    # 表头由第一次买入时确认表格确实为空后写入（见 _write_first_row）
     if df.empty or len(df.columns) < len(COLUMNS):
-        df = pd.DataFrame(columns=COLUMNS)
-        # 初始化一个空表写入，防止后续报错
-        conn.update(worksheet="Sheet1", data=df)
-        return df
+        return pd.DataFrame(columns=COLUMNS)
     
     # 确保列名正确（防止读取脏数据）
     # 有时候读取会多出空列，这里只取我们需要的列
@@ -39,51 +146,165 @@ def get_data():
         if col not in df.columns:
             df[col] = None
             
-    # 强制转换数据类型
-    df['id'] = pd.to_numeric(df['id'], errors='coerce').fillna(0).astype(int)
-    df['buy_price'] = pd.to_numeric(df['buy_price'], errors='coerce').fillna(0.0)
-    df['sell_price'] = pd.to_numeric(df['sell_price'], errors='coerce').fillna(0.0)
-    df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce').fillna(0).astype(int)
-    df['pnl'] = pd.to_numeric(df['pnl'], errors='coerce').fillna(0.0)
+    # 强制转换数据类型（一次性处理所有数值列）
+    num_cols = list(NUMERIC_DTYPES)
+    df[num_cols] = df[num_cols].apply(pd.to_numeric, errors='coerce')
+    df = df.fillna({col: 0 for col in num_cols}).astype(NUMERIC_DTYPES)
     
     # 日期处理
-    df['open_date'] = pd.to_datetime(df['open_date'], errors='coerce')
-    df['close_date'] = pd.to_datetime(df['close_date'], errors='coerce')
+    df[DATE_COLUMNS] = df[DATE_COLUMNS].apply(pd.to_datetime, errors='coerce')
     
     return df
 
-def save_data(df):
-    """将 DataFrame 写回 Google Sheets"""
-    conn = st.connection("gsheets", type=GSheetsConnection)
-    
+def get_data():
+    """读取数据的唯一入口，所有读取都经过 get_data_cached"""
+    return get_data_cached()
+
+def _format_for_sheet(df):
+    """把 DataFrame 转成适合写入 Google Sheets 的格式（日期转字符串、空值转空串）"""
     # 复制一份数据进行处理，以免影响原数据
     save_df = df.copy()
     
-    # --- 修复核心：强制转换为 datetime 类型 ---
-    # errors='coerce' 会把无法转换的数据（如空字符串、乱码）变成 NaT (时间格式的空值)
-    save_df['open_date'] = pd.to_datetime(save_df['open_date'], errors='coerce')
-    save_df['close_date'] = pd.to_datetime(save_df['close_date'], errors='coerce')
-
-    # --- 现在可以安全使用 .dt 了 ---
-    save_df['open_date'] = save_df['open_date'].dt.strftime('%Y-%m-%d')
-    save_df['close_date'] = save_df['close_date'].dt.strftime('%Y-%m-%d')
+    for col in DATE_COLUMNS:
+        # --- 修复核心：不是 datetime 类型时才强制转换 ---
+        # errors='coerce' 会把无法转换的数据（如空字符串、乱码）变成 NaT (时间格式的空值)
+        if not pd.api.types.is_datetime64_any_dtype(save_df[col]):
+            save_df[col] = pd.to_datetime(save_df[col], errors='coerce')
+        # --- 现在可以安全使用 .dt 了 ---
+        save_df[col] = save_df[col].dt.strftime('%Y-%m-%d')
     
     # 把 NaT 和 NaN 替换成空字符串，保持 Google Sheets 干净
-    save_df = save_df.fillna("")
+    return save_df.fillna("")
+
+# 表头占第 1 行，DataFrame 的第 i 行对应表格的第 i+2 行
+_HEADER_ROWS = 1
+_LAST_COL = chr(ord('A') + len(COLUMNS) - 1)
+
+class StaleSheetError(Exception):
+    """本地缓存的数据与表格实际内容不一致，本次写入已取消"""
+
+def _get_worksheet():
+    """取得 gspread Worksheet 对象，用于按行读写
+    
+    st-gsheets-connection 没有公开按行写入的接口，这里依赖 0.1.x 版本
+    service account 客户端的私有方法 _select_worksheet。
+    """
+    select_worksheet = getattr(CONN.client, "_select_worksheet", None)
+    if select_worksheet is None:
+        raise RuntimeError(
+            "按行写入需要 st-gsheets-connection 0.1.x 的 service account 连接，"
+            "请检查依赖版本和 secrets 中的 gsheets 配置"
+        )
+    return select_worksheet(worksheet="Sheet1")
+
+def _check_row(worksheet, i, trade_id):
+    """写入前确认表格第 i 行确实是 trade_id，不一致说明缓存已过期"""
+    value = worksheet.acell(f"A{i}").value
+    if pd.to_numeric(value, errors='coerce') != trade_id:
+        _invalidate_cache()
+        raise StaleSheetError("表格内容已被修改，数据已刷新，请重新选择后再操作")
+
+def _sheet_row(row_index):
+    """DataFrame 行号 -> Google Sheets 行号"""
+    return int(row_index) + _HEADER_ROWS + 1
+
+def _row_values(rows):
+    """把若干行 dict 转成可直接写入表格的二维列表"""
+    return _format_for_sheet(pd.DataFrame(rows, columns=COLUMNS)).values.tolist()
+
+def _clear_memory_caches():
+    get_data_cached.clear()
+    # 派生视图按内容做缓存键，旧条目不会被误用，这里清掉只是及时释放内存
+    get_open_positions.clear()
+    get_closed_trades.clear()
+    get_sell_options.clear()
+    get_delete_options.clear()
+    get_closed_stats.clear()
+
+def _invalidate_cache():
+    # 写入成功后让缓存失效，下次读取会拿到最新数据
+    _clear_disk_cache()
+    _clear_memory_caches()
+
+def save_data(df):
+    """将 DataFrame 连同表头整表写回 Google Sheets（会清空整张表，只能在确认空表后调用）"""
+    CONN.update(worksheet="Sheet1", data=_format_for_sheet(df))
+    _invalidate_cache()
+
+def append_row(row_dict):
+    """追加一行到表尾 (values.append)"""
+    # 只追加这一行；写入失败直接抛给调用方，不留任何待补写的状态，避免之后重复写入
+    _get_worksheet().append_rows(_row_values([row_dict]), value_input_option="USER_ENTERED")
+    _invalidate_cache()
+
+def update_row(row_index, row_dict):
+    """只覆盖指定的一行 (values.update A{i}:K{i})"""
+    i = _sheet_row(row_index)
+    worksheet = _get_worksheet()
+    _check_row(worksheet, i, row_dict["id"])
+    worksheet.update(
+        range_name=f"A{i}:{_LAST_COL}{i}",
+        values=_row_values([row_dict]),
+        value_input_option="USER_ENTERED",
+    )
+    _invalidate_cache()
+
+def delete_row(row_index, trade_id):
+    """删除指定的一行 (batchUpdate deleteDimension)"""
+    i = _sheet_row(row_index)
+    worksheet = _get_worksheet()
+    _check_row(worksheet, i, trade_id)
+    worksheet.delete_rows(i)
+    _invalidate_cache()
+
+@st.cache_resource
+def _id_counter():
+    """进程内所有会话共享的 ID 计数器 + 锁，next 为 None 表示尚未初始化"""
+    return {"next": None, "lock": threading.Lock()}
+
+def _next_trade_id(df):
+    """生成新 ID：所有会话共用一个加锁的计数器
     
-    conn.update(worksheet="Sheet1", data=save_df)
+    只在进程启动后第一次买入时扫描一次当前最大 ID 做初始化，之后每次都是 O(1)。
+    注意：直接在 Google Sheets 里手工添加、且 ID 大于计数器的行不会被感知到。
+    """
+    counter = _id_counter()
+    with counter["lock"]:
+        if counter["next"] is None:
+            counter["next"] = 1
+            if not df.empty and df['id'].max() > 0:
+                counter["next"] = int(df['id'].max()) + 1
+        new_id = counter["next"]
+        counter["next"] = new_id + 1
+    return new_id
 
-def add_buy_position(symbol, buy_price, quantity, open_date, notes):
-    """开仓（买入）- 追加行"""
-    df = get_data()
+def _write_first_row(row_dict):
+    """缓存里是空表时写入第一行
     
-    # 自动生成 ID (取当前最大ID + 1)
-    new_id = 1
-    if not df.empty and 'id' in df.columns:
-        if df['id'].max() > 0:
-            new_id = int(df['id'].max()) + 1
-            
-    new_row = pd.DataFrame([{
+    缓存为空不代表表格真的为空（读取瞬时失败、列名被改），
+    所以先读前两行确认，只有确实是空表才整表写入表头和这一行。
+    """
+    values = _get_worksheet().get_values(f"A1:{_LAST_COL}2")
+    if not values:
+        # 真正的空表：显式指定列名整表写入，表头随第一行一起写进去
+        save_data(pd.DataFrame([row_dict], columns=COLUMNS))
+        return
+    
+    _invalidate_cache()
+    if values[0][:len(COLUMNS)] != COLUMNS:
+        raise StaleSheetError(f"Sheet1 第一行表头与预期不符，应为: {', '.join(COLUMNS)}")
+    if len(values) > 1:
+        raise StaleSheetError("表格内容已被修改，数据已刷新，请重新提交")
+    # 只有表头没有数据，正常追加
+    append_row(row_dict)
+
+def add_buy_position(symbol, buy_price, quantity, open_date, notes, df=None):
+    """开仓（买入）- 追加行，返回更新后的 DataFrame"""
+    if df is None:
+        df = get_data()
+    new_id = _next_trade_id(df)
+    
+    row = {
         "id": new_id,
         "symbol": symbol.upper(),
         "buy_price": buy_price,
@@ -95,15 +316,20 @@ def add_buy_position(symbol, buy_price, quantity, open_date, notes):
         "pnl_percent": 0.0,
         "status": "OPEN",
         "notes": notes
-    }])
+    }
     
-    # 追加并保存
-    updated_df = pd.concat([df, new_row], ignore_index=True)
-    save_data(updated_df)
+    if df.empty:
+        _write_first_row(row)
+    else:
+        append_row(row)
+    
+    # 缓存已失效，重新读取一次最新数据
+    return get_data()
 
-def close_position(trade_id, sell_price, close_date, notes):
-    """平仓（卖出）- 更新行"""
-    df = get_data()
+def close_position(trade_id, sell_price, close_date, notes, df=None):
+    """平仓（卖出）- 更新行，返回更新后的 DataFrame"""
+    if df is None:
+        df = get_data()
     
     # 找到对应的行索引
     mask = df['id'] == trade_id
@@ -124,45 +350,115 @@ def close_position(trade_id, sell_price, close_date, notes):
         
         new_notes = (str(old_notes) + f" | 卖出备注: {notes}") if old_notes else notes
         
-        # 更新 DataFrame
-        df.at[idx, 'sell_price'] = sell_price
-        df.at[idx, 'close_date'] = pd.to_datetime(close_date)
-        df.at[idx, 'pnl'] = pnl
-        df.at[idx, 'pnl_percent'] = pnl_percent
-        df.at[idx, 'status'] = 'CLOSED'
-        df.at[idx, 'notes'] = new_notes
+        # 更新 DataFrame（一次赋值写完整行）
+        df.loc[idx, ['sell_price', 'close_date', 'pnl', 'pnl_percent', 'status', 'notes']] = [
+            sell_price, pd.to_datetime(close_date), pnl, pnl_percent, 'CLOSED', new_notes
+        ]
         
-        save_data(df)
+        # 只把这一行写回表格
+        update_row(idx, df.loc[idx].to_dict())
+    
+    return df
 
-def delete_trade(trade_id):
-    """删除记录"""
-    df = get_data()
-    # 过滤掉要删除的 ID
-    df = df[df['id'] != trade_id]
-    save_data(df)
+def delete_trade(trade_id, df=None):
+    """删除记录，返回更新后的 DataFrame"""
+    if df is None:
+        df = get_data()
+    mask = df['id'] == trade_id
+    if not mask.any():
+        return df
+    
+    idx = df[mask].index[0]
+    delete_row(idx, trade_id)
+    # 重新编号，保持行号与表格一致
+    return df.drop(index=idx).reset_index(drop=True)
+
+def _frame_key(df):
+    """派生视图的缓存键：整张表的内容摘要
+    
+    平仓、外部改价都不改变行数和最大 ID，只有按内容哈希才能保证
+    任何会话拿到的都是和自己手里数据一致的结果。
+    """
+    return (len(df), int(pd.util.hash_pandas_object(df, index=False).sum()))
 
-def get_open_positions():
-    df = get_data()
+@st.cache_data(max_entries=20, show_spinner=False, hash_funcs={pd.DataFrame: _frame_key})
+def get_open_positions(df):
     if df.empty: return df
     return df[df['status'] == 'OPEN']
 
-def get_closed_trades():
-    df = get_data()
+@st.cache_data(max_entries=20, show_spinner=False, hash_funcs={pd.DataFrame: _frame_key})
+def get_closed_trades(df):
     if df.empty: return df
+    # get_data_cached 已经把 close_date 转成 datetime，可以直接排序
     df = df[df['status'] == 'CLOSED']
-    # 确保日期列是 datetime 对象以便排序
-    df['close_date'] = pd.to_datetime(df['close_date'])
     return df.sort_values(by='close_date', ascending=False)
 
+@st.cache_data(max_entries=20, show_spinner=False, hash_funcs={pd.DataFrame: _frame_key})
+def get_sell_options(df):
+    """平仓下拉框的 {标签: ID} 映射"""
+    labels = (df['symbol'].astype(str) + " (成本: " + df['buy_price'].astype(str)
+              + ", 股数: " + df['quantity'].astype(str) + ") - ID:" + df['id'].astype(str))
+    return dict(zip(labels.tolist(), df['id'].tolist()))
+
+@st.cache_data(max_entries=20, show_spinner=False, hash_funcs={pd.DataFrame: _frame_key})
+def get_delete_options(df):
+    """删除下拉框的 {标签: ID} 映射，按 ID 倒序排列，方便删最新的"""
+    df = df.sort_values(by='id', ascending=False)
+    open_dates = df['open_date'].dt.strftime('%Y-%m-%d').fillna("")
+    labels = ("[" + df['status'].astype(str) + "] " + df['symbol'].astype(str)
+              + " (" + open_dates + ") - ID:" + df['id'].astype(str))
+    return dict(zip(labels.tolist(), df['id'].tolist()))
+
+@st.cache_data(max_entries=20, show_spinner=False, hash_funcs={pd.DataFrame: _frame_key})
+def get_closed_stats(df):
+    """已平仓交易的汇总指标，每列只遍历一次"""
+    pnl = df['pnl'].to_numpy()
+    cost = df['buy_price'].to_numpy() * df['quantity'].to_numpy()
+    n = pnl.size
+    return {
+        "total_invested": float(cost.sum()),
+        "total_pnl": float(pnl.sum()),
+        "win_rate": float((pnl > 0).mean() * 100) if n else 0.0,
+        "count": n,
+    }
+
+def _chart_key(df):
+    """图表缓存键：只看图表用到的列的内容"""
+    return int(pd.util.hash_pandas_object(df[['symbol', 'pnl', 'close_date']], index=False).sum())
+
+@st.cache_data(show_spinner=False, hash_funcs={pd.DataFrame: _chart_key})
+def _build_cumpnl_fig(df):
+    """资金曲线"""
+    df = df.sort_values(by='close_date')
+    df['cumulative_pnl'] = df['pnl'].cumsum()
+    return px.line(df, x='close_date', y='cumulative_pnl', title="资金曲线", markers=True)
+
+@st.cache_data(show_spinner=False, hash_funcs={pd.DataFrame: _chart_key})
+def _build_pnl_bar(df):
+    """个股盈亏分布"""
+    df = df.assign(color=np.where(df['pnl'].to_numpy() >= 0, '盈利', '亏损'))
+    return px.bar(df, x='symbol', y='pnl', color='color', 
+                  color_discrete_map={'盈利': '#00CC96', '亏损': '#EF553B'},
+                  title="个股盈亏分布")
+
+@st.cache_data(show_spinner=False)
+def _closed_to_csv(df, columns):
+    """导出历史记录 CSV，内容不变时直接复用上次的结果"""
+    return df.to_csv(index=False, columns=columns, date_format='%Y-%m-%d').encode('utf-8', errors='ignore')
+
+# 本次运行共用的一份数据，写入后就地替换为最新结果，避免重复读取
+_DATA = get_data()
+
 # --- 侧边栏：核心操作区 ---
 st.sidebar.header("📝 交易操作")
 
 # 1. 选择操作模式
-action_type = st.sidebar.radio("选择操作类型", ["🔵 新建买入 (建仓)", "🔴 平仓卖出 (结算)"])
+ACTION_LABELS = {"buy": "🔵 新建买入 (建仓)", "sell": "🔴 平仓卖出 (结算)"}
+action_type = st.sidebar.radio("选择操作类型", options=list(ACTION_LABELS), format_func=ACTION_LABELS.get)
 
 with st.sidebar.form("trade_form", clear_on_submit=True):
     
-    if "买入" in action_type:
+    if action_type == "buy":
         st.subheader("建仓信息")
         symbol = st.text_input("股票代码 (如 AAPL)", max_chars=10)
         col1, col2 = st.columns(2)
@@ -178,22 +474,26 @@ with st.sidebar.form("trade_form", clear_on_submit=True):
         
         if submitted:
             if symbol and price > 0 and quantity > 0:
-                with st.spinner("正在写入 Google Sheets..."):
-                    add_buy_position(symbol, price, quantity, date_val, notes)
-                st.sidebar.success(f"已建立 {symbol} 持仓！")
+                try:
+                    with st.spinner("正在写入 Google Sheets..."):
+                        _DATA = add_buy_position(symbol, price, quantity, date_val, notes, df=_DATA)
+                except StaleSheetError as e:
+                    st.sidebar.error(str(e))
+                    _DATA = get_data()
+                else:
+                    st.sidebar.success(f"已建立 {symbol} 持仓！")
             else:
                 st.sidebar.error("请填写完整信息")
 
     else:
         st.subheader("平仓操作")
-        open_positions = get_open_positions()
+        open_positions = get_open_positions(_DATA)
         
         if open_positions.empty:
             st.warning("当前没有持仓可卖。请先买入。")
             submitted = st.form_submit_button("刷新状态")
         else:
-            options = {f"{row['symbol']} (成本: {row['buy_price']}, 股数: {row['quantity']}) - ID:{row['id']}": row['id'] 
-                       for index, row in open_positions.iterrows()}
+            options = get_sell_options(open_positions)
             
             selected_label = st.selectbox("选择要卖出的持仓", list(options.keys()))
             selected_id = options[selected_label]
@@ -211,70 +511,61 @@ with st.sidebar.form("trade_form", clear_on_submit=True):
             
             if submitted:
                 if selected_id and price > 0:
-                    with st.spinner("正在更新 Google Sheets..."):
-                        close_position(selected_id, price, date_val, notes)
-                    st.sidebar.success("交易已平仓！")
-                    st.rerun()
+                    try:
+                        with st.spinner("正在更新 Google Sheets..."):
+                            _DATA = close_position(selected_id, price, date_val, notes, df=_DATA)
+                    except StaleSheetError as e:
+                        st.sidebar.error(str(e))
+                        _DATA = get_data()
+                    else:
+                        st.sidebar.success("交易已平仓！")
+                        st.rerun()
 
 # --- 主页面 ---
 st.title("📈 投资仓位管理 (Google Sheets版)")
 
 # 1. 顶部：当前持仓
 st.subheader("💼 当前持仓 (Holding)")
-open_df = get_open_positions()
+open_df = get_open_positions(_DATA)
 
 if open_df.empty:
     st.info("目前空仓，请在左侧添加买入记录。")
 else:
-    open_df['Cost Basis'] = open_df['buy_price'] * open_df['quantity']
-    # 格式化显示日期
-    display_open = open_df.copy()
-    # 强制转为 datetime 后再取 date，防止报错
-    display_open['open_date'] = pd.to_datetime(display_open['open_date'], errors='coerce').dt.date
-    st.dataframe(display_open[['symbol', 'buy_price', 'quantity', 'open_date', 'notes']], use_container_width=True)
-    st.caption(f"当前持仓总成本: ${open_df['Cost Basis'].sum():,.2f}")
+    # 直接点积求总成本，不往缓存返回的 DataFrame 里加列
+    cost_total = float(np.dot(open_df['buy_price'].to_numpy(), open_df['quantity'].to_numpy()))
+    # 日期格式交给 column_config 在前端处理，不再为显示单独复制一份数据
+    st.dataframe(open_df, column_order=['symbol', 'buy_price', 'quantity', 'open_date', 'notes'],
+                 column_config=DATE_COLUMN_CONFIG, use_container_width=True)
+    st.caption(f"当前持仓总成本: ${cost_total:,.2f}")
 
 st.markdown("---")
 
 # 2. 底部：历史盈亏
 st.subheader("📊 历史盈亏分析 (Closed)")
-closed_df = get_closed_trades()
+closed_df = get_closed_trades(_DATA)
 
 if not closed_df.empty:
-    total_invested = (closed_df['buy_price'] * closed_df['quantity']).sum()
-    total_pnl = closed_df['pnl'].sum()
-    win_rate = len(closed_df[closed_df['pnl'] > 0]) / len(closed_df) * 100 if len(closed_df) > 0 else 0
+    stats = get_closed_stats(closed_df)
     
     c1, c2, c3 = st.columns(3)
-    c1.metric("已落袋总盈亏", f"${total_pnl:,.2f}", delta_color="normal")
-    c2.metric("交易胜率", f"{win_rate:.1f}%")
-    c3.metric("总交易数", len(closed_df))
+    c1.metric("已落袋总盈亏", f"${stats['total_pnl']:,.2f}", delta_color="normal")
+    c2.metric("交易胜率", f"{stats['win_rate']:.1f}%")
+    c3.metric("总交易数", stats['count'])
 
     col_chart1, col_chart2 = st.columns(2)
     
     with col_chart1:
-        closed_df_sorted = closed_df.sort_values(by='close_date')
-        closed_df_sorted['cumulative_pnl'] = closed_df_sorted['pnl'].cumsum()
-        fig_line = px.line(closed_df_sorted, x='close_date', y='cumulative_pnl', title="资金曲线", markers=True)
-        st.plotly_chart(fig_line, use_container_width=True)
+        st.plotly_chart(_build_cumpnl_fig(closed_df), use_container_width=True)
     
     with col_chart2:
-        closed_df['color'] = closed_df['pnl'].apply(lambda x: '盈利' if x >= 0 else '亏损')
-        fig_bar = px.bar(closed_df, x='symbol', y='pnl', color='color', 
-                         color_discrete_map={'盈利': '#00CC96', '亏损': '#EF553B'},
-                         title="个股盈亏分布")
-        st.plotly_chart(fig_bar, use_container_width=True)
+        st.plotly_chart(_build_pnl_bar(closed_df), use_container_width=True)
 
     with st.expander("查看详细历史交易记录"):
         display_cols = ['symbol', 'open_date', 'close_date', 'buy_price', 'sell_price', 'quantity', 'pnl', 'pnl_percent', 'notes']
-        display_closed = closed_df[display_cols].copy()
-        
-        # --- 修复点：强制转换后再取 .dt.date ---
-        display_closed['open_date'] = pd.to_datetime(display_closed['open_date'], errors='coerce').dt.date
-        display_closed['close_date'] = pd.to_datetime(display_closed['close_date'], errors='coerce').dt.date
         
-        st.dataframe(display_closed, use_container_width=True)
-        csv = display_closed.to_csv(index=False).encode('utf-8')
+        st.dataframe(closed_df, column_order=display_cols,
+                     column_config=DATE_COLUMN_CONFIG, use_container_width=True)
+        csv = _closed_to_csv(closed_df, display_cols)
         st.download_button("📥 导出历史记录 CSV", csv, "closed_trades.csv", "text/csv")
 else:
     st.info("暂无卖出记录。")
@@ -284,22 +575,21 @@ st.markdown("---")
 with st.expander("🗑️ 数据管理：删除记录"):
     st.warning("⚠️ 警告：删除将同步到 Google Sheets，不可恢复！")
     
-    df_all = get_data()
+    df_all = _DATA
     if df_all.empty:
         st.info("无数据。")
     else:
-        # 按 ID 倒序排列，方便删最新的
-        df_all = df_all.sort_values(by='id', ascending=False)
-        delete_options = {
-            f"[{row['status']}] {row['symbol']} ({pd.to_datetime(row['open_date']).date()}) - ID:{row['id']}": row['id']
-            for index, row in df_all.iterrows()
-        }
+        delete_options = get_delete_options(df_all)
 
         selected_label = st.selectbox("选择要删除的记录", list(delete_options.keys()))
         target_id = delete_options[selected_label]
 
         if st.button("❌ 确认删除选中记录"):
-            with st.spinner("正在删除..."):
-                delete_trade(target_id)
-            st.success(f"ID {target_id} 已删除！")
-            st.rerun()
+            try:
+                with st.spinner("正在删除..."):
+                    _DATA = delete_trade(target_id, df=_DATA)
+            except StaleSheetError as e:
+                st.error(str(e))
+            else:
+                st.success(f"ID {target_id} 已删除！")
+                st.rerun()